@@ -11,12 +11,15 @@ Steps:
 
 from __future__ import annotations
 
+import functools
 import json
 import logging
 import os
+import threading
 import time
 from typing import Any, Dict, List, Optional
 
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud import bigquery
 from google.cloud import storage
 from googleapiclient import discovery
@@ -37,6 +40,12 @@ REQUIRED_APIS = [
     "serviceusage.googleapis.com",
     "cloudresourcemanager.googleapis.com",
 ]
+MANIFEST_FIELDS = ("slug", "project_id", "google_ads_customer_id", "business_id")
+MANIFEST_WRITE_ATTEMPTS = 5
+# services.batchEnable accepts at most 20 services per request.
+SERVICE_BATCH_LIMIT = 20
+
+_thread_local = threading.local()
 
 
 def create_client_infra(event: Dict[str, Any], context) -> None:
@@ -57,8 +66,8 @@ def create_client_infra(event: Dict[str, Any], context) -> None:
         logger.warning("Client missing project_id or slug, skipping: %s", client)
         return
 
-    crm = discovery.build("cloudresourcemanager", "v3", cache_discovery=False)
-    serviceusage = discovery.build("serviceusage", "v1", cache_discovery=False)
+    crm = _api_client("cloudresourcemanager", "v3")
+    serviceusage = _api_client("serviceusage", "v1")
 
     logger.info("Provisioning project %s for client %s", project_id, slug)
     ensure_project(crm, project_id, client.get("name") or project_id)
@@ -70,6 +79,27 @@ def create_client_infra(event: Dict[str, Any], context) -> None:
     logger.info("Client %s provisioning complete", slug)
 
 
+def _api_client(service: str, version: str):
+    """Build a discovery client once per thread and reuse it across invocations.
+
+    Discovery clients wrap an httplib2 transport, which is not thread-safe, so
+    the cache is per thread rather than per instance.
+    """
+    clients = getattr(_thread_local, "api_clients", None)
+    if clients is None:
+        clients = _thread_local.api_clients = {}
+    key = (service, version)
+    if key not in clients:
+        clients[key] = discovery.build(service, version, cache_discovery=False)
+    return clients[key]
+
+
+@functools.lru_cache(maxsize=None)
+def _storage_client() -> storage.Client:
+    """Return a Cloud Storage client shared across invocations."""
+    return storage.Client()
+
+
 def ensure_project(crm, project_id: str, display_name: str) -> None:
     """Create the project if it does not exist."""
     try:
@@ -94,31 +124,43 @@ def ensure_project(crm, project_id: str, display_name: str) -> None:
     logger.info("Project %s created under folder %s", project_id, CLIENT_FOLDER_ID)
 
 
-def wait_for_operation(crm, operation_name: str, description: str, timeout: int = 600) -> None:
-    """Poll Cloud Resource Manager operations until completion."""
-    deadline = time.time() + timeout
-    while time.time() < deadline:
-        op = crm.operations().get(name=operation_name).execute()
+def wait_for_operation(api, operation_name: str, description: str, timeout: int = 600) -> None:
+    """Poll a long-running operation (Resource Manager or Service Usage) until completion.
+
+    Polling starts at one second and backs off to five, so short operations
+    return quickly without hammering the API on long ones.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 1.0
+    while time.monotonic() < deadline:
+        op = api.operations().get(name=operation_name).execute()
         if op.get("done"):
             if "error" in op:
                 raise RuntimeError(f"{description} failed: {op['error']}")
             return
-        time.sleep(5)
+        time.sleep(delay)
+        delay = min(delay * 2, 5.0)
     raise TimeoutError(f"{description} did not finish before timeout")
 
 
 def enable_apis(serviceusage, project_id: str, apis: List[str]) -> None:
-    """Enable required APIs; ignore if already enabled."""
-    for api in apis:
-        name = f"projects/{project_id}/services/{api}"
-        try:
-            serviceusage.services().enable(name=name, body={}).execute()
-            logger.info("Enabled API %s", api)
-        except HttpError as err:
-            if err.resp.status == 409:
-                logger.info("API %s already enabled", api)
-                continue
-            raise
+    """Enable required APIs in batches and wait for each batch to finish.
+
+    Already-enabled APIs are a no-op. batchEnable is atomic: if any service ID
+    in a batch cannot be enabled, the whole batch fails and none are enabled.
+    """
+    parent = f"projects/{project_id}"
+    for start in range(0, len(apis), SERVICE_BATCH_LIMIT):
+        batch = apis[start:start + SERVICE_BATCH_LIMIT]
+        operation = serviceusage.services().batchEnable(
+            parent=parent, body={"serviceIds": batch}
+        ).execute()
+        logger.info("Requested enablement of APIs %s", ", ".join(batch))
+        if not operation.get("done"):
+            wait_for_operation(serviceusage, operation["name"], "API enablement")
+        elif "error" in operation:
+            raise RuntimeError(f"API enablement failed: {operation['error']}")
+        logger.info("Enabled APIs %s", ", ".join(batch))
 
 
 def link_billing(project_id: str) -> None:
@@ -127,7 +169,7 @@ def link_billing(project_id: str) -> None:
         logger.info("Skipping billing linkage, BILLING_ACCOUNT_ID not set")
         return
 
-    billing = discovery.build("cloudbilling", "v1", cache_discovery=False)
+    billing = _api_client("cloudbilling", "v1")
     name = f"projects/{project_id}"
     body = {"billingAccountName": f"billingAccounts/{BILLING_ACCOUNT_ID}"}
 
@@ -150,30 +192,49 @@ def ensure_bigquery_dataset(project_id: str, dataset_id: str) -> None:
 
 
 def update_clients_manifest(client: Dict[str, Any]) -> None:
-    """Ensure clients.json is updated with the latest client entry."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(CLIENTS_BUCKET)
+    """Ensure clients.json is updated with the latest client entry.
+
+    The write is conditional on the generation that was read, so concurrent
+    provisioning runs cannot overwrite each other's entries; on a conflict the
+    manifest is re-read and merged again.
+    """
+    bucket = _storage_client().bucket(CLIENTS_BUCKET)
     blob = bucket.blob(CLIENTS_FILENAME)
+    entry = {field: client.get(field) or "" for field in MANIFEST_FIELDS}
 
     entries: List[Dict[str, Any]]
 
-    if blob.exists():
-        entries = json.loads(blob.download_as_text())
-    else:
-        entries = []
-
-    filtered = [row for row in entries if row.get("slug") != client.get("slug")]
-    filtered.append(
-        {
-            "slug": client.get("slug") or "",
-            "project_id": client.get("project_id") or "",
-            "google_ads_customer_id": client.get("google_ads_customer_id") or "",
-            "business_id": client.get("business_id") or "",
-        }
-    )
+    for _ in range(MANIFEST_WRITE_ATTEMPTS):
+        try:
+            entries = json.loads(blob.download_as_text())
+            generation = blob.generation
+        except NotFound:
+            entries = []
+            generation = 0
+
+        filtered = [row for row in entries if row.get("slug") != client.get("slug")]
+        if len(entries) - len(filtered) == 1 and entry in entries:
+            logger.info("clients.json already up to date for slug %s", client.get("slug"))
+            return
+
+        filtered.append(entry)
 
-    blob.upload_from_string(json.dumps(filtered, indent=2), content_type="application/json")
-    logger.info("clients.json updated with slug %s", client.get("slug"))
+        try:
+            blob.upload_from_string(
+                json.dumps(filtered, indent=2),
+                content_type="application/json",
+                if_generation_match=generation,
+            )
+        except PreconditionFailed:
+            logger.info("clients.json changed concurrently, merging slug %s again", client.get("slug"))
+            continue
+
+        logger.info("clients.json updated with slug %s", client.get("slug"))
+        return
+
+    raise RuntimeError(
+        f"Could not update {CLIENTS_FILENAME} after {MANIFEST_WRITE_ATTEMPTS} attempts"
+    )
 
 
 def _decode_firestore_fields(fields: Dict[str, Any]) -> Dict[str, Any]: